@@ -128,6 +128,16 @@ bool alarmRinging = false;
 unsigned long lastPollTime = 0;
 unsigned long lastScanTime = 0;
 const unsigned long POLL_INTERVAL = 2000;
+
+/**
+ * Long-poll settings used while idle.
+ *
+ * - `POLL_WAIT_SECONDS`: how long the server may hold an idle poll open
+ *   waiting for the alarm to start (server caps this at 30s)
+ * - `POLL_WAIT_TIMEOUT`: HTTP timeout for a long poll, a little above the wait
+ */
+const int POLL_WAIT_SECONDS = 25;
+const unsigned long POLL_WAIT_TIMEOUT = 30000;
 const unsigned long SCAN_INTERVAL = 800;
 
 /**
@@ -195,7 +205,9 @@ void stopAlarm() {
  * Poll the backend to determine whether the alarm should currently be ringing.
  *
  * Request:
- * - `GET {SERVER_URL}/api/device/poll`
+ * - `GET {SERVER_URL}/api/device/poll?wait=POLL_WAIT_SECONDS` while idle
+ *   (long poll: the server answers as soon as the alarm starts, or after the wait)
+ * - `GET {SERVER_URL}/api/device/poll` while ringing (answers immediately)
  *
  * Expected response (simple string matching):
  * - If the response body contains `"ALARM_RINGING"` => alarm should ring.
@@ -210,14 +222,20 @@ void stopAlarm() {
  *
  * Notes:
  * - This uses plaintext HTTP and no authentication; suitable for trusted LAN.
- * - `HTTPClient` is used in blocking mode; timeouts are set to 3 seconds.
+ * - `HTTPClient` is used in blocking mode; timeouts are set to 3 seconds, or
+ *   `POLL_WAIT_TIMEOUT` for a long poll.
  */
 void pollServer() {
   HTTPClient http;
   String url = String(SERVER_URL) + "/api/device/poll";
   
-  http.begin(url);
-  http.setTimeout(3000);
+  if (alarmRinging) {
+    http.begin(url);
+    http.setTimeout(3000);
+  } else {
+    http.begin(url + "?wait=" + String(POLL_WAIT_SECONDS));
+    http.setTimeout(POLL_WAIT_TIMEOUT);
+  }
   
   int httpCode = http.GET();
   
@@ -2,15 +2,48 @@
 Alarm Manager - state machine and scheduler for alarm logic
 """
 import asyncio
+import hmac
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Optional, Callable, Awaitable, TYPE_CHECKING
 
-from database import db, Alarm, AlarmState, User
+from database import db, Alarm, User
+from log import get_logger
 from qr_handler import generate_qr_token, generate_qr_image
 
 if TYPE_CHECKING:
     from telegram_bot import TelegramBot
 
+logger = get_logger("alarm_manager")
+
+# Longest the check loop sleeps with nothing due, so ringing alarms still time out
+MAX_IDLE_SLEEP_SECONDS = 60
+
+# A ringing alarm nobody scans expires after this long
+RING_TIMEOUT = timedelta(minutes=10)
+
+# Longest a device poll may be held open waiting for a state change
+MAX_POLL_WAIT_SECONDS = 30
+
+# Outgoing Telegram notifications
+NOTIFY_QR = "qr"                 # QR code for a ringing alarm
+NOTIFY_STOPPED = "stopped"       # "Good morning" after a successful scan
+NOTIFY_QUEUE_SIZE = 256
+NOTIFY_MAX_ATTEMPTS = 4
+NOTIFY_RETRY_BASE_SECONDS = 2    # Doubles after each failed attempt
+NOTIFY_BATCH_SIZE = 25
+NOTIFY_SEND_INTERVAL = 1 / 25    # Stays under Telegram's 30 messages/second
+
+
+@dataclass
+class Notification:
+    """A Telegram message waiting for the notification worker."""
+    kind: str                    # NOTIFY_QR or NOTIFY_STOPPED
+    user: User
+    alarm: Alarm
+    qr_image: Optional[bytes] = None
+    attempt: int = 0
+
 
 class AlarmManager:
     """
@@ -20,65 +53,105 @@ class AlarmManager:
     
     def __init__(self):
         self._check_task: Optional[asyncio.Task] = None
+        self._notify_task: Optional[asyncio.Task] = None
         self._telegram_bot: Optional["TelegramBot"] = None
         
-        # Current state for ESP32 polling
+        # Telegram sends run on their own task so network latency
+        # never holds up the alarm state machine
+        self._notify_q: asyncio.Queue[Notification] = asyncio.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+        self._notify_pending: set[tuple[str, int]] = set()  # (kind, alarm_id)
+        self._last_notify_at = 0.0  # loop.time() of the last send, for pacing
+        
+        # Wakes the check loop early when an alarm is set before the one
+        # it is currently sleeping towards
+        self._wake = asyncio.Event()
+        self._next_due: Optional[datetime] = None
+        self.max_idle_sleep: float = MAX_IDLE_SLEEP_SECONDS
+        
+        # Current state for ESP32 polling - kept in memory, seeded from the
+        # database on start and re-read only when another process writes to it
         self._device_state = "IDLE"  # "IDLE" or "ALARM_RINGING"
-        self._current_qr_token: Optional[str] = None
+        self._current_qr_token: Optional[bytes] = None  # Stripped and encoded once for scan checks
         self._current_ringing_alarm_id: Optional[int] = None
         self._current_ringing_user_id: Optional[int] = None
+        self._data_version: Optional[int] = None
+        
+        # Set (and replaced) whenever the device state changes, for long-polling
+        self.state_change_event = asyncio.Event()
     
     def set_telegram_bot(self, bot: "TelegramBot"):
         """Set telegram bot reference for notifications."""
         self._telegram_bot = bot
     
     async def start(self):
-        """Start the alarm checking background task."""
+        """Start the alarm checking and notification background tasks."""
         if self._check_task is None:
+            self._rehydrate()
             self._check_task = asyncio.create_task(self._check_loop())
-            print("Alarm manager started")
+            self._notify_task = asyncio.create_task(self._notify_worker())
+            logger.info("Alarm manager started")
     
     async def stop(self):
-        """Stop the alarm checking background task."""
+        """Stop the alarm checking and notification background tasks."""
         if self._check_task:
-            self._check_task.cancel()
-            try:
-                await self._check_task
-            except asyncio.CancelledError:
-                pass
+            for task in (self._check_task, self._notify_task):
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
             self._check_task = None
-            print("Alarm manager stopped")
+            self._notify_task = None
+            logger.info("Alarm manager stopped")
     
     async def _check_loop(self):
         """Background loop that checks for alarms to trigger."""
         while True:
             try:
-                await self._check_alarms()
-                await asyncio.sleep(1)  # Check every second
+                self._wake.clear()
+                now = datetime.now()
+                await self._check_alarms(now)
+                self._sync_external_changes()
+                await self._sleep_until_next_alarm(now)
             except asyncio.CancelledError:
                 break
             except Exception as e:
-                print(f"Alarm check error: {e}")
+                logger.exception("Alarm check error: %s", e)
                 await asyncio.sleep(5)
     
-    async def _check_alarms(self):
-        """Check if any scheduled alarm should trigger now."""
-        now = datetime.now()
+    async def _sleep_until_next_alarm(self, now: datetime):
+        """Sleep until the next alarm is due, the schedule changes, or the idle cap passes."""
+        timeout = self.max_idle_sleep
+        next_time = db.get_next_trigger_time()
+        self._next_due = next_time
+        if next_time:
+            until_next = (next_time - now).total_seconds()
+            # An overdue alarm that failed to trigger is retried every second
+            timeout = min(timeout, until_next if until_next > 0 else 1)
         
-        # Get all scheduled alarms
-        scheduled = db.get_scheduled_alarms()
-        
-        for alarm in scheduled:
-            if alarm.trigger_time <= now:
-                await self._trigger_alarm(alarm)
-                break  # Only trigger one at a time
+        # A timer on the same event avoids wait_for(), which can swallow stop()'s cancellation
+        timer = asyncio.get_running_loop().call_later(timeout, self._wake.set)
+        try:
+            await self._wake.wait()
+        finally:
+            timer.cancel()
+    
+    def _wake_check_loop(self):
+        """Wake the check loop, coalescing with a wake-up that is already pending."""
+        if not self._wake.is_set():
+            self._wake.set()
+    
+    async def _check_alarms(self, now: datetime):
+        """Check if any scheduled alarm should trigger at the given time."""
+        # Only trigger one at a time
+        due = db.get_due_alarm_id(now)
+        if due:
+            await self._trigger_alarm(*due, now)
         
         # Check for expired ringing alarm (10 minute timeout)
-        ringing = db.get_ringing_alarm()
-        if ringing and ringing.triggered_at:
-            elapsed = (now - ringing.triggered_at).total_seconds()
-            if elapsed > 600:  # 10 minutes
-                await self._expire_alarm(ringing)
+        timed_out_id = db.get_ringing_expiry(now - RING_TIMEOUT)
+        if timed_out_id is not None:
+            await self._expire_alarm(timed_out_id)
         
         # Check for unnotified completed alarms (for separate process mode)
         # Only if we have a bot to send messages
@@ -89,122 +162,218 @@ class AlarmManager:
     async def _check_ringing_qr_notifications(self):
         """Check for ringing alarms that need QR codes sent (for separate bot process)."""
         needing_qr = db.get_ringing_alarms_needing_qr()
+        undeliverable = []  # No user or token - flagged so they aren't fetched every pass
         
         for alarm in needing_qr:
-            if not alarm.user_id or not alarm.qr_token:
+            if (NOTIFY_QR, alarm.id) in self._notify_pending:
                 continue
             
-            print(f"[BOT] Sending QR code for ringing alarm {alarm.id}")
-            user = db.get_user_by_id(alarm.user_id)
+            user = db.get_user_by_id(alarm.user_id) if alarm.user_id else None
+            if not user or not alarm.qr_token:
+                undeliverable.append(alarm.id)
+                continue
             
-            if user:
-                try:
-                    # Generate QR image from the token that was saved by the server
-                    qr_image = generate_qr_image(alarm.qr_token)
-                    await self._telegram_bot.send_alarm_qr(user, qr_image)
-                    db.mark_qr_sent(alarm.id)
-                    print(f"[BOT] ✅ QR code sent for alarm {alarm.id}")
-                except Exception as e:
-                    print(f"[BOT] ❌ Failed to send QR: {e}")
-                    # Mark as sent to avoid spam loop
-                    db.mark_qr_sent(alarm.id)
+            logger.debug("Queueing QR code for ringing alarm %s", alarm.id)
+            # Use the image stored with the alarm; older rows only have the token
+            qr = db.get_alarm_qr(alarm.id)
+            if qr and qr[0] == alarm.qr_token:
+                qr_image = qr[1]
+            else:
+                qr_image = await asyncio.to_thread(generate_qr_image, alarm.qr_token)
+            self._enqueue_notify(NOTIFY_QR, user, alarm, qr_image)
+        
+        db.mark_qr_codes_sent(undeliverable)
 
     async def _check_notifications(self):
         """Check for completed alarms that haven't been notified."""
         unnotified = db.get_unnotified_alarms()
+        undeliverable = []
         
         for alarm in unnotified:
-            if not alarm.user_id:
+            if (NOTIFY_STOPPED, alarm.id) in self._notify_pending:
+                continue
+            
+            user = db.get_user_by_id(alarm.user_id) if alarm.user_id else None
+            if not user:
+                undeliverable.append(alarm.id)
                 continue
-                
-            print(f"Sending success notification for alarm {alarm.id}")
-            user = db.get_user_by_id(alarm.user_id) if hasattr(db, 'get_user_by_id') else None
             
-            if user:
+            logger.debug("Queueing success notification for alarm %s", alarm.id)
+            self._enqueue_notify(NOTIFY_STOPPED, user, alarm)
+        
+        db.mark_notifications_sent(undeliverable)
+    
+    def _enqueue_notify(
+        self,
+        kind: str,
+        user: User,
+        alarm: Alarm,
+        qr_image: Optional[bytes] = None
+    ):
+        """Hand a notification to the worker without waiting for Telegram."""
+        key = (kind, alarm.id)
+        if key in self._notify_pending:
+            return
+        
+        try:
+            self._notify_q.put_nowait(Notification(kind, user, alarm, qr_image))
+        except asyncio.QueueFull:
+            # Still unmarked in the DB, so a later check will queue it again
+            logger.warning("Notification queue full, dropping %s for alarm %s", kind, alarm.id)
+            return
+        
+        self._notify_pending.add(key)
+    
+    async def _notify_worker(self):
+        """Background task that delivers queued Telegram notifications in batches."""
+        loop = asyncio.get_running_loop()
+        while True:
+            # Block for the first message, then take whatever else is already waiting
+            batch = [await self._notify_q.get()]
+            while len(batch) < NOTIFY_BATCH_SIZE and not self._notify_q.empty():
+                batch.append(self._notify_q.get_nowait())
+            
+            try:
+                await self._send_batch(batch, loop)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                # e.g. "database is locked" while flagging - keep serving the queue.
+                # Unflagged rows are queued again by the periodic checks.
+                logger.exception("Notification worker error: %s", e)
+                for item in batch:
+                    self._notify_pending.discard((item.kind, item.alarm.id))
+    
+    async def _send_batch(self, batch: list[Notification], loop: asyncio.AbstractEventLoop):
+        """Send one batch at the paced rate, then flag what was delivered."""
+        delivered: list[Notification] = []
+        try:
+            for item in batch:
+                wait = self._last_notify_at + NOTIFY_SEND_INTERVAL - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._last_notify_at = loop.time()
+                
                 try:
-                    await self._telegram_bot.send_alarm_stopped(user, alarm)
-                    # Only mark as sent if successful (or if we want to avoid retry loops on error?)
-                    # Let's mark it to avoid infinite loops if network is down
-                    db.mark_notification_sent(alarm.id)
+                    await self._send_notification(item)
+                except asyncio.CancelledError:
+                    raise
                 except Exception as e:
-                    print(f"Failed to send notification: {e}")
-                    # Force mark as sent to avoid spam/loops, or implement retry logic later
-                    # For now, mark as sent so we don't crash
-                    db.mark_notification_sent(alarm.id)
-
+                    self._retry_notification(item, e)
+                else:
+                    delivered.append(item)
+        finally:
+            # One UPDATE per flag for the whole batch
+            self._finish_notifications(delivered)
+    
+    async def _send_notification(self, item: Notification):
+        """Send one notification through the Telegram bot."""
+        if item.kind == NOTIFY_QR:
+            await self._telegram_bot.send_alarm_qr(item.user, item.qr_image)
+            logger.info("QR code sent for alarm %s", item.alarm.id)
+        else:
+            await self._telegram_bot.send_alarm_stopped(item.user, item.alarm)
+            logger.info("Success notification sent for alarm %s", item.alarm.id)
+    
+    def _finish_notifications(self, items: list[Notification]):
+        """Record notifications as delivered (or given up on)."""
+        qr_ids = []
+        stopped_ids = []
+        for item in items:
+            self._notify_pending.discard((item.kind, item.alarm.id))
+            if item.kind == NOTIFY_QR:
+                qr_ids.append(item.alarm.id)
+            else:
+                stopped_ids.append(item.alarm.id)
+        
+        db.mark_qr_codes_sent(qr_ids)
+        db.mark_notifications_sent(stopped_ids)
     
-    async def _trigger_alarm(self, alarm: Alarm):
+    def _retry_notification(self, item: Notification, error: Exception):
+        """Schedule another attempt with exponential backoff, without blocking the queue."""
+        item.attempt += 1
+        if item.attempt >= NOTIFY_MAX_ATTEMPTS:
+            logger.error("Giving up on %s for alarm %s: %s", item.kind, item.alarm.id, error)
+            # Mark it anyway so the periodic check doesn't resend it forever
+            self._finish_notifications([item])
+            return
+        
+        # Telegram's flood control says exactly how long to wait
+        delay = getattr(error, "retry_after", None) or NOTIFY_RETRY_BASE_SECONDS * 2 ** (item.attempt - 1)
+        logger.warning("Failed to send %s for alarm %s (%s), retrying in %ss", item.kind, item.alarm.id, error, delay)
+        asyncio.get_running_loop().call_later(delay, self._requeue_notification, item)
+    
+    def _requeue_notification(self, item: Notification):
+        """Put a notification back on the queue after its backoff delay."""
+        try:
+            self._notify_q.put_nowait(item)
+        except asyncio.QueueFull:
+            self._finish_notifications([item])
+    
+    
+    async def _trigger_alarm(self, alarm_id: int, user_id: int, now: datetime):
         """Trigger an alarm - start ringing."""
-        print(f"=" * 50)
-        print(f"TRIGGERING ALARM {alarm.id} for user {alarm.user_id}")
-        print(f"=" * 50)
+        logger.info("Triggering alarm %s for user %s", alarm_id, user_id)
         
         # Get user for this alarm
-        user = db.get_user_by_id(alarm.user_id) if hasattr(db, 'get_user_by_id') else None
+        user = db.get_user_by_id(user_id)
         
         if not user:
-            print(f"ERROR: User {alarm.user_id} not found!")
+            logger.error("User %s not found for alarm %s", user_id, alarm_id)
             return
         
-        print(f"User found: {user.name} (chat_id: {user.chat_id})")
+        logger.debug("User found: %s (chat_id: %s)", user.name, user.chat_id)
         
-        # Generate QR token and image
-        token = generate_qr_token()
-        qr_image = generate_qr_image(token)
-        print(f"Generated QR token: {token}")
-        print(f"QR image size: {len(qr_image)} bytes")
+        # The token and image are normally generated when the alarm is set;
+        # only alarms created before that was the case need them made here
+        qr = db.get_alarm_qr(alarm_id)
+        if qr:
+            token, qr_image = qr
+        else:
+            token = generate_qr_token()
+            qr_image = await asyncio.to_thread(generate_qr_image, token)
+        logger.debug("Generated QR token %s (%d byte image)", token, len(qr_image))
         
         # Update database FIRST (so alarm still rings even if Telegram fails)
-        now = datetime.now()
-        db.update_alarm_state(
-            alarm.id,
-            AlarmState.RINGING,
-            qr_token=token,
-            triggered_at=now
-        )
-        print("Database updated: State = RINGING")
+        db.mark_ringing(alarm_id, token, now)
+        logger.debug("Database updated: state = RINGING")
+        
+        # Re-check the schedule right away in case another alarm is also due
+        self._wake_check_loop()
         
         # Update device state
         self._device_state = "ALARM_RINGING"
-        self._current_qr_token = token
-        self._current_ringing_alarm_id = alarm.id
-        self._current_ringing_user_id = alarm.user_id
-        print("Device state updated: ALARM_RINGING")
+        self._current_qr_token = token.strip().encode()
+        self._current_ringing_alarm_id = alarm_id
+        self._current_ringing_user_id = user_id
+        self._state_changed()
+        logger.debug("Device state updated: ALARM_RINGING")
         
-        # Send QR code via Telegram (with error handling)
-        if self._telegram_bot and user:
-            try:
-                print(f"Attempting to send QR code to Telegram chat {user.chat_id}...")
-                await self._telegram_bot.send_alarm_qr(user, qr_image)
-                print("✅ QR CODE SENT SUCCESSFULLY!")
-            except Exception as e:
-                print(f"❌ FAILED to send QR code to Telegram: {e}")
-                print(f"Alarm is still RINGING - user can scan from device or check logs")
-                # Don't crash - alarm should still work via device scanning
+        # Send QR code via Telegram in the background - the alarm rings
+        # on the device regardless of whether this gets through
+        if self._telegram_bot:
+            logger.debug("Queueing QR code for Telegram chat %s", user.chat_id)
+            # Only the notification needs the full row
+            alarm = db.get_alarm(alarm_id)
+            self._enqueue_notify(NOTIFY_QR, user, alarm, qr_image)
         else:
-            if not self._telegram_bot:
-                print("WARNING: Telegram bot not set")
-            if not user:
-                print("WARNING: User not found")
-        
-        print(f"=" * 50)
+            logger.warning("Telegram bot not set, QR code for alarm %s not sent", alarm_id)
     
-    async def _expire_alarm(self, alarm: Alarm):
+    async def _expire_alarm(self, alarm_id: int):
         """Expire an alarm that wasn't stopped in time."""
-        print(f"Expiring alarm {alarm.id}")
+        logger.info("Expiring alarm %s", alarm_id)
         
-        db.update_alarm_state(alarm.id, AlarmState.EXPIRED)
+        db.mark_expired(alarm_id)
         
-        # Reset device state
-        self._device_state = "IDLE"
-        self._current_qr_token = None
-        self._current_ringing_alarm_id = None
-        self._current_ringing_user_id = None
+        # Re-read rather than reset - the expired alarm may not be the one the
+        # device is showing, and another may still be ringing
+        self._rehydrate()
     
-    def set_alarm(self, user_id: int, hour: int, minute: int) -> Alarm:
+    async def set_alarm(self, user_id: int, hour: int, minute: int) -> Alarm:
         """
         Set a new alarm for the given user and time.
         If time has passed today, schedule for tomorrow.
+        The QR token and image are generated now, off the event loop, and stored with the alarm.
         """
         now = datetime.now()
         trigger_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
@@ -213,12 +382,22 @@ class AlarmManager:
         if trigger_time <= now:
             trigger_time += timedelta(days=1)
         
-        # Cancel any existing scheduled alarms for this user
+        token = generate_qr_token()
+        qr_image = await asyncio.to_thread(generate_qr_image, token)
+        
+        # Cancel any existing scheduled alarms for this user. No awaits from
+        # here on, so a second /set can't slip in between cancel and create.
         db.cancel_user_scheduled_alarms(user_id)
         
         # Create new alarm
-        alarm = db.create_alarm(user_id, trigger_time)
-        print(f"Alarm set for user {user_id} at {trigger_time}")
+        alarm = db.create_alarm(user_id, trigger_time, now, token, qr_image)
+        logger.info("Alarm set for user %s at %s", user_id, trigger_time)
+        
+        # Only disturb the loop if this alarm is due before whatever it's waiting for.
+        # A cancelled earlier alarm just costs the loop one wasted wake-up.
+        if self._next_due is None or trigger_time < self._next_due:
+            self._next_due = trigger_time
+            self._wake_check_loop()
         
         return alarm
     
@@ -254,19 +433,51 @@ class AlarmManager:
         count = db.cancel_user_scheduled_alarms(user_id)
         return count > 0
     
-    def get_device_state(self) -> str:
-        """Get current state for ESP32 polling - reads from database."""
+    def _rehydrate(self):
+        """Seed the in-memory device state from the ringing alarm in the database."""
+        self._data_version = db.data_version()
+        previous_state = self._device_state
         ringing = db.get_ringing_alarm()
         if ringing:
-            # Update in-memory state from database
             self._device_state = "ALARM_RINGING"
             self._current_ringing_alarm_id = ringing.id
             self._current_ringing_user_id = ringing.user_id
-            self._current_qr_token = ringing.qr_token
-            return "ALARM_RINGING"
+            self._current_qr_token = ringing.qr_token.strip().encode() if ringing.qr_token else None
         else:
             self._device_state = "IDLE"
-            return "IDLE"
+            self._current_qr_token = None
+            self._current_ringing_alarm_id = None
+            self._current_ringing_user_id = None
+        
+        if self._device_state != previous_state:
+            self._state_changed()
+    
+    def _sync_external_changes(self):
+        """Re-read device state if another process (split bot/server mode) wrote to the database."""
+        if db.data_version() != self._data_version:
+            self._rehydrate()
+    
+    def _state_changed(self):
+        """Wake every long-poll waiting on the current event; later polls wait on a fresh one."""
+        self.state_change_event.set()
+        self.state_change_event = asyncio.Event()
+    
+    def get_device_state(self) -> str:
+        """Get current state for ESP32 polling."""
+        return self._device_state
+    
+    async def wait_for_device_state(self, wait: float) -> str:
+        """
+        Long-poll variant of get_device_state.
+        While idle, holds the request for up to `wait` seconds until the state changes.
+        """
+        wait = min(wait, MAX_POLL_WAIT_SECONDS)
+        if self._device_state == "IDLE" and wait > 0:
+            try:
+                await asyncio.wait_for(self.state_change_event.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+        return self._device_state
     
     async def process_scan(self, scanned_token: str) -> dict:
         """
@@ -280,43 +491,28 @@ class AlarmManager:
             return {"action": "CONTINUE", "message": "No QR token set"}
         
         # Check if token matches
-        if scanned_token.strip() == self._current_qr_token.strip():
+        if hmac.compare_digest(scanned_token.strip().encode(), self._current_qr_token):
             # Success! Stop the alarm
             alarm_id = self._current_ringing_alarm_id
             user_id = self._current_ringing_user_id
             
             if alarm_id:
-                ringing = db.get_alarm(alarm_id)
-                if ringing:
-                    now = datetime.now()
-                    wake_time = None
-                    if ringing.triggered_at:
-                        wake_time = int((now - ringing.triggered_at).total_seconds())
-                    
-                    db.update_alarm_state(
-                        alarm_id,
-                        AlarmState.COMPLETED,
-                        stopped_at=now,
-                        wake_time_seconds=wake_time
-                    )
-                    
-                    # Reset device state
-                    self._device_state = "IDLE"
-                    self._current_qr_token = None
-                    self._current_ringing_alarm_id = None
-                    self._current_ringing_user_id = None
+                # Marks it completed and returns the updated row in one statement
+                alarm = db.complete_alarm_returning(alarm_id, datetime.now())
+                if alarm:
+                    # Falls back to any other alarm still ringing
+                    self._rehydrate()
                     
                     # Send success message via Telegram
                     if self._telegram_bot and user_id:
-                        user = db.get_user_by_id(user_id) if hasattr(db, 'get_user_by_id') else None
-                        alarm = db.get_alarm(alarm_id)
-                        if user and alarm:
-                            await self._telegram_bot.send_alarm_stopped(user, alarm)
+                        user = db.get_user_by_id(user_id)
+                        if user:
+                            self._enqueue_notify(NOTIFY_STOPPED, user, alarm)
                     
                     return {
                         "action": "STOP",
                         "message": "Alarm stopped successfully",
-                        "wake_time_seconds": wake_time
+                        "wake_time_seconds": alarm.wake_time_seconds
                     }
         
         return {"action": "CONTINUE", "message": "Invalid QR code"}
@@ -27,6 +27,12 @@ class Config:
     # Database
     DATABASE_PATH: Path = Path(__file__).parent / "alarm_data.db"
     
+    # QR decoding: "fastzbarlight" (used when installed) or "pyzbar"
+    QR_DECODER: str = os.getenv("QR_DECODER", "fastzbarlight").lower()
+    
+    # Logging (DEBUG, INFO, WARNING, ...)
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO").upper()
+    
     @classmethod
     def validate(cls) -> list[str]:
         """Validate required configuration. Returns list of missing items."""
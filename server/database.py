@@ -2,15 +2,38 @@
 Database module - SQLite setup and models for alarm persistence
 """
 import sqlite3
+import threading
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Sequence
 from dataclasses import dataclass
 from enum import Enum
 
 from config import config
 
 
+# Bound once at import; called for every timestamp column read.
+# Alarm timestamps are stored as INTEGER unix seconds.
+_fromisoformat = datetime.fromisoformat
+_fromtimestamp = datetime.fromtimestamp
+
+
+def _to_ts(value: datetime) -> int:
+    """Convert a naive local datetime to unix seconds for storage."""
+    return int(value.timestamp())
+
+
+# Fixed statements for the alarm state transitions, so sqlite3's
+# statement cache can reuse the compiled form instead of re-parsing
+SQL_SET_RINGING = "UPDATE alarms SET state = ?, qr_token = ?, triggered_at = ? WHERE id = ?"
+SQL_SET_COMPLETED = (
+    "UPDATE alarms SET state = ?, stopped_at = ?, wake_time_seconds = ?, notification_sent = ? "
+    "WHERE id = ?"
+)
+SQL_SET_EXPIRED = "UPDATE alarms SET state = ? WHERE id = ?"
+SQL_SET_NOTIFIED = "UPDATE alarms SET notification_sent = 1 WHERE id = ?"
+
+
 class AlarmState(Enum):
     """Possible states for an alarm."""
     SCHEDULED = "scheduled"      # Waiting for trigger time
@@ -20,7 +43,11 @@ class AlarmState(Enum):
     CANCELLED = "cancelled"      # Manually cancelled by user
 
 
-@dataclass
+# Stored state string -> AlarmState, a plain dict hit instead of Enum.__call__
+_STATE_FROM_STR = {state.value: state for state in AlarmState}
+
+
+@dataclass(slots=True, frozen=True)
 class User:
     """Registered user model."""
     id: int
@@ -29,7 +56,7 @@ class User:
     registered_at: datetime
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Alarm:
     """Alarm data model."""
     id: int
@@ -49,62 +76,148 @@ class Database:
     
     def __init__(self, db_path: Path = config.DATABASE_PATH):
         self.db_path = db_path
+        
+        # One connection for the whole process, in autocommit mode.
+        # The lock covers the odd call made from a worker thread.
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        
+        # Users are never edited or deleted, so a row once found stays valid.
+        # Misses aren't cached: the other process may register the user later.
+        self._users_by_id: dict[int, User] = {}
+        self._users_by_chat_id: dict[str, User] = {}
+        
+        self._configure_connection()
         self._init_db()
     
-    def _get_connection(self) -> sqlite3.Connection:
-        """Get a database connection with row factory."""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+    def _configure_connection(self):
+        """Apply connection-level pragmas."""
+        # WAL lets the server and bot processes read while the other writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA mmap_size=67108864")
+        self._conn.execute("PRAGMA cache_size=-20000")
+    
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
     
     def _init_db(self):
         """Initialize database schema."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        # Users table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                registered_at TEXT NOT NULL
-            )
-        """)
-        
-        # Alarms table with user foreign key
-        cursor.execute("""
+        with self._lock:
+            # Users table
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id TEXT UNIQUE NOT NULL,
+                    name TEXT NOT NULL,
+                    registered_at TEXT NOT NULL
+                )
+            """)
+            
+            # Alarms table with user foreign key
+            self._create_alarms_table()
+            # Columns first - the timestamp rebuild copies the flag columns over
+            self._add_missing_alarm_columns()
+            self._migrate_alarm_timestamps()
+            
+            # Index for quick lookup of active alarms
+            self._conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_alarm_state
+                ON alarms(state)
+            """)
+            
+            # Index for finding the next due alarm without a scan
+            self._conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_alarm_sched_time
+                ON alarms(state, trigger_time)
+            """)
+            
+            # Index for user lookup by chat_id
+            self._conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_user_chat_id
+                ON users(chat_id)
+            """)
+    
+    def _create_alarms_table(self):
+        """Create the alarms table if it doesn't exist."""
+        self._conn.execute("""
             CREATE TABLE IF NOT EXISTS alarms (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
-                trigger_time TEXT NOT NULL,
+                trigger_time INTEGER NOT NULL,
                 state TEXT NOT NULL DEFAULT 'scheduled',
                 qr_token TEXT,
-                created_at TEXT NOT NULL,
-                triggered_at TEXT,
-                stopped_at TEXT,
+                created_at INTEGER NOT NULL,
+                triggered_at INTEGER,
+                stopped_at INTEGER,
                 wake_time_seconds INTEGER,
                 notification_sent INTEGER DEFAULT 0,
                 qr_sent INTEGER DEFAULT 0,
+                qr_image BLOB,
                 FOREIGN KEY (user_id) REFERENCES users(id)
             )
         """)
-        
-        # Index for quick lookup of active alarms
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_alarm_state 
-            ON alarms(state)
-        """)
-
-        
-        # Index for user lookup by chat_id
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_user_chat_id 
-            ON users(chat_id)
-        """)
-        
-        conn.commit()
-        conn.close()
+    
+    def _migrate_alarm_timestamps(self):
+        """Rebuild an old alarms table that stored timestamps as ISO-8601 TEXT."""
+        # SQLite can't change a column type in place, so copy into a fresh table.
+        # The 'utc' modifier reads the stored text as local time, like _to_ts().
+        # The type is checked under the write lock, so when the server and bot
+        # start together only the first one rebuilds.
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = {
+                row["name"]: row["type"]
+                for row in self._conn.execute("PRAGMA table_info(alarms)")
+            }
+            if columns.get("trigger_time") != "TEXT":
+                self._conn.execute("COMMIT")
+                return
+            
+            self._conn.execute("ALTER TABLE alarms RENAME TO alarms_old")
+            self._create_alarms_table()
+            self._conn.execute("""
+                INSERT INTO alarms (
+                    id, user_id, trigger_time, state, qr_token, created_at,
+                    triggered_at, stopped_at, wake_time_seconds, notification_sent, qr_sent
+                )
+                SELECT
+                    id, user_id,
+                    CAST(strftime('%s', trigger_time, 'utc') AS INTEGER),
+                    state, qr_token,
+                    CAST(strftime('%s', created_at, 'utc') AS INTEGER),
+                    CAST(strftime('%s', triggered_at, 'utc') AS INTEGER),
+                    CAST(strftime('%s', stopped_at, 'utc') AS INTEGER),
+                    wake_time_seconds, notification_sent, qr_sent
+                FROM alarms_old
+            """)
+            # Dropping the old table also drops its indexes; _init_db recreates them
+            self._conn.execute("DROP TABLE alarms_old")
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+    
+    def _add_missing_alarm_columns(self):
+        """Add columns introduced after an existing alarms table was created."""
+        existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(alarms)")}
+        added = {
+            "notification_sent": "INTEGER DEFAULT 0",
+            "qr_sent": "INTEGER DEFAULT 0",
+            "qr_image": "BLOB",
+        }
+        for name, decl in added.items():
+            if name not in existing:
+                try:
+                    self._conn.execute(f"ALTER TABLE alarms ADD COLUMN {name} {decl}")
+                except sqlite3.OperationalError as e:
+                    # The other process (split server/bot mode) added it first
+                    if "duplicate column name" not in str(e):
+                        raise
     
     # ===================
     # USER METHODS
@@ -116,61 +229,66 @@ class Database:
             id=row["id"],
             chat_id=row["chat_id"],
             name=row["name"],
-            registered_at=datetime.fromisoformat(row["registered_at"])
+            registered_at=_fromisoformat(row["registered_at"])
         )
     
+    def _cache_user(self, user: User) -> User:
+        """Remember a user under both lookup keys."""
+        self._users_by_id[user.id] = user
+        self._users_by_chat_id[user.chat_id] = user
+        return user
+    
+    def get_cached_user_by_chat_id(self, chat_id: str) -> Optional[User]:
+        """Get a user already loaded by this process, without touching the database."""
+        return self._users_by_chat_id.get(str(chat_id))
+    
     def get_user_by_chat_id(self, chat_id: str) -> Optional[User]:
         """Get user by Telegram chat ID."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        user = self._users_by_chat_id.get(str(chat_id))
+        if user:
+            return user
         
-        cursor.execute("SELECT * FROM users WHERE chat_id = ?", (str(chat_id),))
-        row = cursor.fetchone()
-        conn.close()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM users WHERE chat_id = ?", (str(chat_id),)
+            ).fetchone()
         
-        return self._row_to_user(row) if row else None
+        return self._cache_user(self._row_to_user(row)) if row else None
     
     def get_user_by_id(self, user_id: int) -> Optional[User]:
         """Get user by ID."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        user = self._users_by_id.get(user_id)
+        if user:
+            return user
         
-        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM users WHERE id = ?", (user_id,)
+            ).fetchone()
         
-        return self._row_to_user(row) if row else None
+        return self._cache_user(self._row_to_user(row)) if row else None
     
     def register_user(self, chat_id: str, name: str) -> User:
         """Register a new user."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
         now = datetime.now()
-        cursor.execute("""
-            INSERT INTO users (chat_id, name, registered_at)
-            VALUES (?, ?, ?)
-        """, (str(chat_id), name, now.isoformat()))
-        
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return User(
+        with self._lock:
+            cursor = self._conn.execute("""
+                INSERT INTO users (chat_id, name, registered_at)
+                VALUES (?, ?, ?)
+            """, (str(chat_id), name, now.isoformat()))
+            user_id = cursor.lastrowid
+        
+        return self._cache_user(User(
             id=user_id,
             chat_id=str(chat_id),
             name=name,
             registered_at=now
-        )
+        ))
     
     def get_all_users(self) -> list[User]:
         """Get all registered users."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM users")
-        rows = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM users").fetchall()
         
         return [self._row_to_user(row) for row in rows]
     
@@ -183,38 +301,42 @@ class Database:
         return Alarm(
             id=row["id"],
             user_id=row["user_id"],
-            trigger_time=datetime.fromisoformat(row["trigger_time"]),
-            state=AlarmState(row["state"]),
+            trigger_time=_fromtimestamp(row["trigger_time"]),
+            state=_STATE_FROM_STR[row["state"]],
             qr_token=row["qr_token"],
-            created_at=datetime.fromisoformat(row["created_at"]),
-            triggered_at=datetime.fromisoformat(row["triggered_at"]) if row["triggered_at"] else None,
-            stopped_at=datetime.fromisoformat(row["stopped_at"]) if row["stopped_at"] else None,
+            created_at=_fromtimestamp(row["created_at"]),
+            triggered_at=_fromtimestamp(row["triggered_at"]) if row["triggered_at"] else None,
+            stopped_at=_fromtimestamp(row["stopped_at"]) if row["stopped_at"] else None,
             wake_time_seconds=row["wake_time_seconds"],
-            # Defaults to False for backward compatibility or new rows
-            notification_sent=bool(row["notification_sent"]) if "notification_sent" in row.keys() else False
+            notification_sent=bool(row["notification_sent"])
         )
     
-    def create_alarm(self, user_id: int, trigger_time: datetime) -> Alarm:
-        """Create a new scheduled alarm for a user."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        now = datetime.now()
-        cursor.execute("""
-            INSERT INTO alarms (user_id, trigger_time, state, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, trigger_time.isoformat(), AlarmState.SCHEDULED.value, now.isoformat()))
-        
-        alarm_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+    def create_alarm(
+        self,
+        user_id: int,
+        trigger_time: datetime,
+        now: Optional[datetime] = None,
+        qr_token: Optional[str] = None,
+        qr_image: Optional[bytes] = None
+    ) -> Alarm:
+        """
+        Create a new scheduled alarm for a user.
+        The QR token and image can be stored up front so triggering doesn't have to generate them.
+        """
+        now = now or datetime.now()
+        with self._lock:
+            cursor = self._conn.execute("""
+                INSERT INTO alarms (user_id, trigger_time, state, created_at, qr_token, qr_image)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user_id, _to_ts(trigger_time), AlarmState.SCHEDULED.value, _to_ts(now), qr_token, qr_image))
+            alarm_id = cursor.lastrowid
         
         return Alarm(
             id=alarm_id,
             user_id=user_id,
             trigger_time=trigger_time,
             state=AlarmState.SCHEDULED,
-            qr_token=None,
+            qr_token=qr_token,
             created_at=now,
             triggered_at=None,
             stopped_at=None,
@@ -223,66 +345,98 @@ class Database:
     
     def get_alarm(self, alarm_id: int) -> Optional[Alarm]:
         """Get alarm by ID."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM alarms WHERE id = ?", (alarm_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM alarms WHERE id = ?", (alarm_id,)
+            ).fetchone()
         
         return self._row_to_alarm(row) if row else None
     
+    def get_alarm_qr(self, alarm_id: int) -> Optional[tuple[str, bytes]]:
+        """Get the (token, PNG image) generated for an alarm, if both were stored."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT qr_token, qr_image FROM alarms WHERE id = ?", (alarm_id,)
+            ).fetchone()
+        
+        if row and row[0] and row[1]:
+            return row[0], row[1]
+        return None
+    
     def get_scheduled_alarms(self) -> list[Alarm]:
         """Get all scheduled (pending) alarms."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT * FROM alarms 
-            WHERE state = ? 
-            ORDER BY trigger_time ASC
-        """, (AlarmState.SCHEDULED.value,))
-        
-        rows = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT * FROM alarms
+                WHERE state = ?
+                ORDER BY trigger_time ASC
+            """, (AlarmState.SCHEDULED.value,)).fetchall()
         
         return [self._row_to_alarm(row) for row in rows]
     
+    def get_due_alarm_id(self, now: datetime) -> Optional[tuple[int, int]]:
+        """Get (id, user_id) of the earliest scheduled alarm whose trigger time has passed."""
+        with self._lock:
+            row = self._conn.execute("""
+                SELECT id, user_id FROM alarms
+                WHERE state = ? AND trigger_time <= ?
+                ORDER BY trigger_time ASC
+                LIMIT 1
+            """, (AlarmState.SCHEDULED.value, _to_ts(now))).fetchone()
+        
+        return (row[0], row[1]) if row else None
+    
+    def get_ringing_expiry(self, cutoff: datetime) -> Optional[int]:
+        """Get the id of a ringing alarm that started ringing before the cutoff."""
+        with self._lock:
+            row = self._conn.execute("""
+                SELECT id FROM alarms
+                WHERE state = ? AND triggered_at < ?
+                LIMIT 1
+            """, (AlarmState.RINGING.value, _to_ts(cutoff))).fetchone()
+        
+        return row[0] if row else None
+    
+    def get_next_trigger_time(self) -> Optional[datetime]:
+        """Get the trigger time of the earliest scheduled alarm."""
+        with self._lock:
+            row = self._conn.execute("""
+                SELECT MIN(trigger_time) AS next_time FROM alarms
+                WHERE state = ?
+            """, (AlarmState.SCHEDULED.value,)).fetchone()
+        
+        return _fromtimestamp(row["next_time"]) if row["next_time"] else None
+    
     def get_ringing_alarm(self) -> Optional[Alarm]:
         """Get the currently ringing alarm (should only be one)."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT * FROM alarms 
-            WHERE state = ? 
-            LIMIT 1
-        """, (AlarmState.RINGING.value,))
-        
-        row = cursor.fetchone()
-        conn.close()
+        with self._lock:
+            row = self._conn.execute("""
+                SELECT * FROM alarms
+                WHERE state = ?
+                LIMIT 1
+            """, (AlarmState.RINGING.value,)).fetchone()
         
         return self._row_to_alarm(row) if row else None
     
+    def data_version(self) -> int:
+        """Counter that changes whenever another connection commits to the database."""
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+    
     def get_user_scheduled_alarms(self, user_id: int) -> list[Alarm]:
         """Get scheduled alarms for a specific user."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT * FROM alarms 
-            WHERE user_id = ? AND state = ? 
-            ORDER BY trigger_time ASC
-        """, (user_id, AlarmState.SCHEDULED.value))
-        
-        rows = cursor.fetchall()
-        conn.close()
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT * FROM alarms
+                WHERE user_id = ? AND state = ?
+                ORDER BY trigger_time ASC
+            """, (user_id, AlarmState.SCHEDULED.value)).fetchall()
         
         return [self._row_to_alarm(row) for row in rows]
     
     def update_alarm_state(
-        self, 
-        alarm_id: int, 
+        self,
+        alarm_id: int,
         state: AlarmState,
         qr_token: Optional[str] = None,
         triggered_at: Optional[datetime] = None,
@@ -290,10 +444,31 @@ class Database:
         wake_time_seconds: Optional[int] = None,
         notification_sent: Optional[bool] = None
     ):
-        """Update alarm state and related fields."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
+        """
+        Update alarm state and related fields.
+        Common transitions go through the fixed-statement helpers below.
+        """
+        no_stop_fields = stopped_at is None and wake_time_seconds is None
+        no_ring_fields = qr_token is None and triggered_at is None
+        
+        if state == AlarmState.RINGING and qr_token and triggered_at and no_stop_fields \
+                and notification_sent is None:
+            self.mark_ringing(alarm_id, qr_token, triggered_at)
+            return
+        
+        # Only when every column mark_completed writes was passed - the legacy
+        # call leaves anything it wasn't given untouched
+        if state == AlarmState.COMPLETED and stopped_at and no_ring_fields \
+                and wake_time_seconds is not None and notification_sent is not None:
+            self.mark_completed(alarm_id, stopped_at, wake_time_seconds, notification_sent)
+            return
+        
+        if state == AlarmState.EXPIRED and no_ring_fields and no_stop_fields \
+                and notification_sent is None:
+            self.mark_expired(alarm_id)
+            return
+        
+        # Anything else is rare enough to build the statement on the fly
         updates = ["state = ?"]
         values = [state.value]
         
@@ -303,124 +478,151 @@ class Database:
         
         if triggered_at is not None:
             updates.append("triggered_at = ?")
-            values.append(triggered_at.isoformat())
+            values.append(_to_ts(triggered_at))
         
         if stopped_at is not None:
             updates.append("stopped_at = ?")
-            values.append(stopped_at.isoformat())
+            values.append(_to_ts(stopped_at))
         
         if wake_time_seconds is not None:
             updates.append("wake_time_seconds = ?")
             values.append(wake_time_seconds)
-            
+        
         if notification_sent is not None:
             updates.append("notification_sent = ?")
             values.append(1 if notification_sent else 0)
         
         values.append(alarm_id)
         
-        cursor.execute(f"""
-            UPDATE alarms 
-            SET {', '.join(updates)}
-            WHERE id = ?
-        """, values)
+        with self._lock:
+            self._conn.execute(f"""
+                UPDATE alarms
+                SET {', '.join(updates)}
+                WHERE id = ?
+            """, values)
+    
+    def mark_ringing(self, alarm_id: int, qr_token: str, triggered_at: datetime):
+        """Mark an alarm as ringing with its QR token."""
+        with self._lock:
+            self._conn.execute(
+                SQL_SET_RINGING,
+                (AlarmState.RINGING.value, qr_token, _to_ts(triggered_at), alarm_id)
+            )
+    
+    def mark_completed(
+        self,
+        alarm_id: int,
+        stopped_at: datetime,
+        wake_time_seconds: Optional[int],
+        notification_sent: bool = False
+    ):
+        """Mark an alarm as stopped by a successful scan."""
+        with self._lock:
+            self._conn.execute(
+                SQL_SET_COMPLETED,
+                (AlarmState.COMPLETED.value, _to_ts(stopped_at), wake_time_seconds,
+                 1 if notification_sent else 0, alarm_id)
+            )
+    
+    def complete_alarm_returning(self, alarm_id: int, stopped_at: datetime) -> Optional[Alarm]:
+        """
+        Mark an alarm as stopped and return the updated row.
+        Wake time is worked out in SQL from the stored triggered_at.
+        """
+        with self._lock:
+            row = self._conn.execute("""
+                UPDATE alarms
+                SET state = ?, stopped_at = ?, wake_time_seconds = ? - triggered_at
+                WHERE id = ?
+                RETURNING *
+            """, (AlarmState.COMPLETED.value, _to_ts(stopped_at), _to_ts(stopped_at), alarm_id)).fetchone()
         
-        conn.commit()
-        conn.close()
+        return self._row_to_alarm(row) if row else None
+    
+    def mark_expired(self, alarm_id: int):
+        """Mark an alarm as timed out."""
+        with self._lock:
+            self._conn.execute(SQL_SET_EXPIRED, (AlarmState.EXPIRED.value, alarm_id))
     
     def cancel_user_scheduled_alarms(self, user_id: int) -> int:
         """Cancel all scheduled alarms for a user. Returns count of cancelled."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE alarms 
-            SET state = ? 
-            WHERE user_id = ? AND state = ?
-        """, (AlarmState.CANCELLED.value, user_id, AlarmState.SCHEDULED.value))
-        
-        count = cursor.rowcount
-        conn.commit()
-        conn.close()
-        
-        return count
+        with self._lock:
+            cursor = self._conn.execute("""
+                UPDATE alarms
+                SET state = ?
+                WHERE user_id = ? AND state = ?
+            """, (AlarmState.CANCELLED.value, user_id, AlarmState.SCHEDULED.value))
+            return cursor.rowcount
     
     def get_user_stats(self, user_id: int) -> dict:
         """Get wake-up statistics for a user."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT COUNT(*) as count, AVG(wake_time_seconds) as avg_time
-            FROM alarms 
-            WHERE user_id = ? AND state = ? AND wake_time_seconds IS NOT NULL
-        """, (user_id, AlarmState.COMPLETED.value))
-        
-        row = cursor.fetchone()
-        conn.close()
+        with self._lock:
+            row = self._conn.execute("""
+                SELECT COUNT(*) as count, AVG(wake_time_seconds) as avg_time
+                FROM alarms
+                WHERE user_id = ? AND state = ? AND wake_time_seconds IS NOT NULL
+            """, (user_id, AlarmState.COMPLETED.value)).fetchone()
         
         return {
             "total_completed": row["count"] or 0,
             "avg_wake_time_seconds": round(row["avg_time"] or 0, 1)
         }
-
+    
     def get_unnotified_alarms(self) -> list[Alarm]:
         """Get completed alarms that haven't been notified yet."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        # Check if column exists first (migration safety)
-        try:
-            cursor.execute("""
-                SELECT * FROM alarms 
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT * FROM alarms
                 WHERE state = ? AND notification_sent = 0
-            """, (AlarmState.COMPLETED.value,))
-            rows = cursor.fetchall()
-        except sqlite3.OperationalError:
-            # Column might not exist yet if DB wasn't recreated
-            rows = []
-        
-        conn.close()
+            """, (AlarmState.COMPLETED.value,)).fetchall()
         
         return [self._row_to_alarm(row) for row in rows]
-
+    
     def mark_notification_sent(self, alarm_id: int):
         """Mark an alarm as notified."""
-        self.update_alarm_state(alarm_id, AlarmState.COMPLETED, notification_sent=True)
-
+        with self._lock:
+            self._conn.execute(SQL_SET_NOTIFIED, (alarm_id,))
+    
+    def mark_notifications_sent(self, alarm_ids: Sequence[int]):
+        """Mark several alarms as notified in one statement."""
+        if not alarm_ids:
+            return
+        
+        placeholders = ",".join("?" * len(alarm_ids))
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE alarms SET notification_sent = 1 WHERE id IN ({placeholders})",
+                list(alarm_ids)
+            )
+    
     def get_ringing_alarms_needing_qr(self) -> list[Alarm]:
         """Get ringing alarms that haven't had QR code sent yet."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute("""
-                SELECT * FROM alarms 
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT * FROM alarms
                 WHERE state = ? AND qr_sent = 0
-            """, (AlarmState.RINGING.value,))
-            rows = cursor.fetchall()
-        except sqlite3.OperationalError:
-            # Column might not exist yet
-            rows = []
-        
-        conn.close()
+            """, (AlarmState.RINGING.value,)).fetchall()
         
         return [self._row_to_alarm(row) for row in rows]
-
+    
     def mark_qr_sent(self, alarm_id: int):
         """Mark that QR code was sent for this alarm."""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute("""
+        with self._lock:
+            self._conn.execute("""
                 UPDATE alarms SET qr_sent = 1 WHERE id = ?
             """, (alarm_id,))
-            conn.commit()
-        except sqlite3.OperationalError:
-            pass  # Column might not exist
-        
-        conn.close()
+    
+    def mark_qr_codes_sent(self, alarm_ids: Sequence[int]):
+        """Mark several alarms as having had their QR code sent, in one statement."""
+        if not alarm_ids:
+            return
+        
+        placeholders = ",".join("?" * len(alarm_ids))
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE alarms SET qr_sent = 1 WHERE id IN ({placeholders})",
+                list(alarm_ids)
+            )
 
 
 # Singleton instance
@@ -0,0 +1,48 @@
+"""
+Logging setup - records are queued on the calling thread and written by a background listener
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+from config import config
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def _start_listener() -> logging.Handler:
+    """Start the shared queue listener once and return a handler that feeds it."""
+    global _listener
+    
+    log_queue: queue.Queue = queue.Queue(-1)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+    
+    _listener = logging.handlers.QueueListener(log_queue, stream)
+    _listener.start()
+    # Flush whatever is still queued on interpreter exit
+    atexit.register(_listener.stop)
+    
+    return logging.handlers.QueueHandler(log_queue)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Get a logger whose records are written off the event loop.
+    Level comes from LOG_LEVEL (default INFO).
+    """
+    root = logging.getLogger("smart_alarm")
+    if _listener is None:
+        root.addHandler(_start_listener())
+        root.propagate = False
+        # getLevelName maps a known name to its number (getLevelNamesMapping is 3.11+)
+        level = logging.getLevelName(config.LOG_LEVEL)
+        if isinstance(level, int):
+            root.setLevel(level)
+        else:
+            root.setLevel(logging.INFO)
+            root.warning("Unknown LOG_LEVEL %r, using INFO", config.LOG_LEVEL)
+    
+    return root.getChild(name)
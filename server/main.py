@@ -8,9 +8,11 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
 
 from config import config
+from database import db
 from alarm_manager import alarm_manager
 from telegram_bot import telegram_bot
-from qr_handler import decode_qr_from_jpeg
+from qr_handler import decode_scan, read_scan_upload
+from responses import ORJSONResponse
 
 
 @asynccontextmanager
@@ -34,23 +36,27 @@ async def lifespan(app: FastAPI):
     
     await telegram_bot.stop()
     await alarm_manager.stop()
+    db.close()
 
 
-app = FastAPI(title="Smart Alarm", lifespan=lifespan)
+app = FastAPI(title="Smart Alarm", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 @app.get("/api/device/poll")
-async def device_poll():
-    return {"state": alarm_manager.get_device_state()}
+async def device_poll(wait: float = 0):
+    return {"state": await alarm_manager.wait_for_device_state(wait)}
 
 
 @app.post("/api/device/scan")
 async def device_scan(request: Request):
-    image_bytes = await request.body()
+    try:
+        image_bytes = await read_scan_upload(request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     if not image_bytes:
         raise HTTPException(status_code=400, detail="No image")
     
-    decoded = decode_qr_from_jpeg(image_bytes)
+    decoded = await decode_scan(image_bytes)
     if not decoded:
         return {"action": "CONTINUE"}
     
@@ -1,41 +1,87 @@
 """
 QR Code handler - generation and validation
 """
+import asyncio
+import hashlib
+import hmac
 import io
 import uuid
-from typing import Optional
+from collections import OrderedDict
+from functools import lru_cache
+from typing import AsyncIterator, Optional
 
 import qrcode
 from PIL import Image
+
+from config import config
+
 from pyzbar.pyzbar import decode as decode_qr
 
+# fastzbarlight bundles an optimised libzbar and decodes several times faster
+# than pyzbar; it only ships for Linux, so pyzbar stays as the fallback
+try:
+    import fastzbarlight
+except ImportError:
+    fastzbarlight = None
+
+USE_FASTZBAR = fastzbarlight is not None and config.QR_DECODER != "pyzbar"
+
+# Any mask pattern is valid; fixing one skips qrcode's search, which builds
+# and scores the matrix once per pattern (8x the work of a single build)
+QR_MASK_PATTERN = 3
+
+# Frames are shrunk to fit this before decoding - zbar's cost grows with pixel
+# count and a phone-screen QR code is still well resolved at this size
+SCAN_MAX_SIDE = 640
+
+# Largest scan upload accepted - ESP32-CAM frames are far smaller
+MAX_SCAN_BYTES = 512 * 1024
+
+# Scans are decoded in worker threads, at most this many at once
+DECODE_CONCURRENCY = 4
+_DECODE_SEM = asyncio.Semaphore(DECODE_CONCURRENCY)
+
+# Results for recently seen frames, so a re-sent upload isn't decoded again
+_RECENT_DECODES: OrderedDict[bytes, Optional[str]] = OrderedDict()
+_RECENT_DECODES_MAX = 32
+
 
 def generate_qr_token() -> str:
     """Generate a unique token for QR code."""
     return f"alarm_{uuid.uuid4().hex[:12]}"
 
 
+@lru_cache(maxsize=256)
 def generate_qr_image(token: str) -> bytes:
     """
     Generate a QR code image containing the token.
-    Returns PNG image as bytes.
+    Returns PNG image as bytes, cached per token.
     """
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_M,
         box_size=10,
         border=4,
+        mask_pattern=QR_MASK_PATTERN,
     )
     qr.add_data(token)
     qr.make(fit=True)
     
-    img = qr.make_image(fill_color="black", back_color="white")
+    # Rasterise the module matrix directly (one pixel per module, then scaled up)
+    # instead of going through an image factory that draws every module
+    matrix = qr.get_matrix()  # Includes the border
+    size = len(matrix)
+    pixels = b"".join(bytes(0 if module else 255 for module in row) for row in matrix)
+    img = Image.frombytes("L", (size, size), pixels).convert("1")
+    img = img.resize((size * qr.box_size, size * qr.box_size), Image.Resampling.NEAREST)
     
     # Convert to bytes
     buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    buffer.seek(0)
+    # A 1-bit QR image barely compresses further, so don't spend time trying
+    img.save(buffer, format="PNG", compress_level=1, optimize=False)
     
+    # getvalue() hands back BytesIO's own buffer without copying when nothing
+    # else references it, so a reused thread-local scratch buffer saves nothing
     return buffer.getvalue()
 
 
@@ -45,11 +91,26 @@ def decode_qr_from_jpeg(image_bytes: bytes) -> Optional[str]:
     Returns the decoded string or None if no QR found.
     """
     try:
-        # Open image from bytes
-        image = Image.open(io.BytesIO(image_bytes))
+        # zbar only looks at luminance - convert once and drop the RGB frame
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            # Let the JPEG decoder skip colour and scale down by 1/2, 1/4 or 1/8
+            # itself (no-op for other formats), then finish with a cheap resize.
+            # Pillow's wheels decode with libjpeg-turbo, so this is the same
+            # grayscale + scaled decode PyTurboJPEG would offer.
+            scale = min(1.0, SCAN_MAX_SIDE / max(image.size))
+            image.draft("L", (int(image.width * scale), int(image.height * scale)))
+            if max(image.size) > SCAN_MAX_SIDE:
+                image.thumbnail((SCAN_MAX_SIDE, SCAN_MAX_SIDE), Image.Resampling.BILINEAR)
+            gray = image.convert("L")
         
-        # Decode QR codes
-        decoded_objects = decode_qr(image)
+        if USE_FASTZBAR:
+            try:
+                return _decode_fastzbar(gray)
+            except Exception as e:
+                _disable_fastzbar(e)
+        
+        # Decode QR codes from the raw 8-bit pixels, skipping pyzbar's own conversion
+        decoded_objects = decode_qr((gray.tobytes(), *gray.size))
         
         if decoded_objects:
             # Return the first QR code found
@@ -62,6 +123,52 @@ def decode_qr_from_jpeg(image_bytes: bytes) -> Optional[str]:
         return None
 
 
+def _decode_fastzbar(gray: Image.Image) -> Optional[str]:
+    """Decode with fastzbarlight's scanner, handing it the 8-bit pixels directly."""
+    # scan_codes() wants a PIL image and asserts with Image.isImageType, which
+    # Pillow 12 removed - the scanner it wraps takes raw luminance bytes
+    codes = fastzbarlight.zbar_code_scanner(b"qrcode.enable", gray.tobytes(), *gray.size)
+    return codes[0].decode("utf-8") if codes else None
+
+
+def _disable_fastzbar(error: Exception):
+    """Switch to pyzbar for good after fastzbarlight fails at runtime."""
+    global USE_FASTZBAR
+    USE_FASTZBAR = False
+    print(f"fastzbarlight failed ({error!r}), decoding with pyzbar from now on")
+
+
+async def read_scan_upload(chunks: AsyncIterator[bytes], limit: int = MAX_SCAN_BYTES) -> bytearray:
+    """
+    Collect an uploaded frame from a request body stream into one buffer.
+    Raises ValueError as soon as the upload passes `limit` bytes.
+    """
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) > limit:
+            raise ValueError(f"Scan upload larger than {limit} bytes")
+    return buffer
+
+
+async def decode_scan(image_bytes: bytes | bytearray) -> Optional[str]:
+    """
+    Async decode_qr_from_jpeg for request handlers.
+    Runs off the event loop and reuses the result for a repeated frame.
+    """
+    digest = hashlib.sha1(image_bytes).digest()
+    if digest in _RECENT_DECODES:
+        return _RECENT_DECODES[digest]
+    
+    async with _DECODE_SEM:
+        decoded = await asyncio.to_thread(decode_qr_from_jpeg, image_bytes)
+    
+    _RECENT_DECODES[digest] = decoded
+    if len(_RECENT_DECODES) > _RECENT_DECODES_MAX:
+        _RECENT_DECODES.popitem(last=False)
+    return decoded
+
+
 def validate_token(scanned: str, expected: str) -> bool:
-    """Check if scanned token matches expected token."""
-    return scanned.strip() == expected.strip()
+    """Check if scanned token matches expected token, in constant time."""
+    return hmac.compare_digest(scanned.strip().encode(), expected.strip().encode())
@@ -0,0 +1,17 @@
+"""
+Response classes shared by the FastAPI apps
+"""
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+class ORJSONResponse(JSONResponse):
+    """
+    JSON response encoded with orjson.
+    Same as fastapi.responses.ORJSONResponse, which newer FastAPI versions deprecate.
+    """
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
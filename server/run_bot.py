@@ -2,10 +2,18 @@
 Run just the Telegram bot (for testing separately)
 """
 import asyncio
+import signal
 import sys
+
+try:
+    import uvloop  # Installed with uvicorn[standard], except on Windows
+except ImportError:
+    uvloop = None
+
 from telegram_bot import telegram_bot
 from alarm_manager import alarm_manager
 from config import config
+from database import db
 
 
 async def main():
@@ -23,6 +31,9 @@ async def main():
     telegram_bot.set_alarm_manager(alarm_manager)
     alarm_manager.set_telegram_bot(telegram_bot)
     
+    # Alarms ring from the separate server process, so watch the shared DB closely
+    alarm_manager.max_idle_sleep = 1
+    
     # Start components
     await alarm_manager.start()
     await telegram_bot.start()
@@ -37,16 +48,26 @@ async def main():
     print("Bot is running! Press Ctrl+C to stop.")
     print("=" * 50)
     
-    # Keep running
+    # Keep running until SIGINT/SIGTERM. Windows has no loop signal handlers;
+    # there Ctrl+C cancels this task instead and the cleanup below still runs.
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    
     try:
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
+        await stop_event.wait()
         print("\nStopping...")
     finally:
         await telegram_bot.stop()
         await alarm_manager.stop()
+        db.close()
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
@@ -1,13 +1,21 @@
 """
 Run just the FastAPI server (for ESP32 communication)
 """
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
 from contextlib import asynccontextmanager
 
 from config import config
+from database import db
 from alarm_manager import alarm_manager
-from qr_handler import decode_qr_from_jpeg
+from log import get_logger
+from qr_handler import decode_scan, read_scan_upload, DECODE_CONCURRENCY
+from responses import ORJSONResponse
+
+logger = get_logger("run_server")
 
 
 @asynccontextmanager
@@ -16,6 +24,13 @@ async def lifespan(app: FastAPI):
     print("Smart Alarm - API Server")
     print("=" * 50)
     
+    # Scan decoding is the only thread-pool work here; size the pool to match
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DECODE_CONCURRENCY)
+    )
+    
+    # Alarms are set from the separate bot process, so watch the shared DB closely
+    alarm_manager.max_idle_sleep = 1
     await alarm_manager.start()
     
     print(f"Server: http://{config.SERVER_HOST}:{config.SERVER_PORT}")
@@ -24,33 +39,37 @@ async def lifespan(app: FastAPI):
     yield
     
     await alarm_manager.stop()
+    db.close()
 
 
-app = FastAPI(title="Smart Alarm API", lifespan=lifespan)
+app = FastAPI(title="Smart Alarm API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 @app.get("/api/device/poll")
-async def device_poll():
-    state = alarm_manager.get_device_state()
-    print(f"[POLL] State: {state}")
+async def device_poll(wait: float = 0):
+    state = await alarm_manager.wait_for_device_state(wait)
+    logger.debug("[POLL] State: %s", state)
     return {"state": state}
 
 
 @app.post("/api/device/scan")
 async def device_scan(request: Request):
-    image_bytes = await request.body()
+    try:
+        image_bytes = await read_scan_upload(request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     
     if not image_bytes:
         raise HTTPException(status_code=400, detail="No image")
     
-    print(f"[SCAN] Received {len(image_bytes)} bytes")
+    logger.debug("[SCAN] Received %d bytes", len(image_bytes))
     
-    decoded = decode_qr_from_jpeg(image_bytes)
+    decoded = await decode_scan(image_bytes)
     
     if not decoded:
         return {"action": "CONTINUE", "message": "No QR found"}
     
-    print(f"[SCAN] QR: {decoded}")
+    logger.debug("[SCAN] QR: %s", decoded)
     result = await alarm_manager.process_scan(decoded)
     return result
 
@@ -61,4 +80,5 @@ async def root():
 
 
 if __name__ == "__main__":
+    # Single process only - AlarmManager keeps the scheduler and device state in memory
     uvicorn.run("run_server:app", host=config.SERVER_HOST, port=config.SERVER_PORT, reload=True)
@@ -3,11 +3,13 @@ Telegram Bot - handles user commands and sends notifications
 Using aiogram for better stability
 """
 import io
+import re
 import asyncio
 from datetime import datetime
 from typing import Optional, Dict, Any
 
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.types import Message, BufferedInputFile
 from aiogram.filters import Command
 from aiogram.enums import ParseMode
@@ -26,6 +28,15 @@ _user_states: Dict[str, str] = {}  # chat_id -> state
 
 WAITING_FOR_NAME = "waiting_for_name"
 
+# "/set H[H][:MM]" (also "/set@bot ..."); extra words after the time are ignored.
+# No match means no argument was given; a match without groups means a bad time.
+_SET_RE = re.compile(r"^/\S+\s+(?=\S)(?:(\d{1,2})(?::(\d{1,2}))?(?:\s|$))?")
+
+# Idle connections to the Bot API are kept open this long (aiohttp's default is 15s),
+# so an alarm notification usually reuses a warm TLS connection
+BOT_KEEPALIVE_SECONDS = 300
+BOT_CONNECTION_LIMIT = 20
+
 
 def set_alarm_manager(manager):
     """Set alarm manager reference."""
@@ -33,16 +44,20 @@ def set_alarm_manager(manager):
     _alarm_manager = manager
 
 
-def _get_user(chat_id: str) -> Optional[User]:
-    """Get registered user by chat ID."""
-    return db.get_user_by_chat_id(str(chat_id))
+async def _get_user(chat_id: str) -> Optional[User]:
+    """Get registered user by chat ID. Only cache misses go to the database, in a worker thread."""
+    chat_id = str(chat_id)
+    user = db.get_cached_user_by_chat_id(chat_id)
+    if user is None:
+        user = await asyncio.to_thread(db.get_user_by_chat_id, chat_id)
+    return user
 
 
 @router.message(Command("start"))
 async def cmd_start(message: Message):
     """Handle /start command - registration flow."""
     chat_id = str(message.chat.id)
-    user = _get_user(chat_id)
+    user = await _get_user(chat_id)
     
     if user:
         await message.answer(
@@ -65,7 +80,7 @@ async def cmd_start(message: Message):
 async def cmd_help(message: Message):
     """Handle /help command."""
     chat_id = str(message.chat.id)
-    user = _get_user(chat_id)
+    user = await _get_user(chat_id)
     
     if not user:
         await message.answer("Please send /start to register first!")
@@ -88,15 +103,15 @@ async def cmd_help(message: Message):
 async def cmd_set(message: Message):
     """Handle /set command to schedule an alarm."""
     chat_id = str(message.chat.id)
-    user = _get_user(chat_id)
+    user = await _get_user(chat_id)
     
     if not user:
         await message.answer("Please send /start to register first!")
         return
     
     # Parse time argument
-    args = message.text.split()[1:] if message.text else []
-    if not args:
+    match = _SET_RE.match(message.text or "")
+    if not match:
         await message.answer(
             "❌ Please specify a time.\n"
             "Example: `/set 07:30`",
@@ -104,16 +119,11 @@ async def cmd_set(message: Message):
         )
         return
     
-    time_str = args[0]
-    try:
-        parts = time_str.split(":")
-        hour = int(parts[0])
-        minute = int(parts[1]) if len(parts) > 1 else 0
-        
-        if not (0 <= hour <= 23 and 0 <= minute <= 59):
-            raise ValueError("Invalid time range")
-        
-    except (ValueError, IndexError):
+    hour_str, minute_str = match.groups()
+    hour = int(hour_str) if hour_str else -1
+    minute = int(minute_str) if minute_str else 0
+    
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
         await message.answer(
             "❌ Invalid time format.\n"
             "Use HH:MM (24-hour format), e.g., `/set 07:30`",
@@ -122,7 +132,7 @@ async def cmd_set(message: Message):
         return
     
     if _alarm_manager:
-        alarm = _alarm_manager.set_alarm(user.id, hour, minute)
+        alarm = await _alarm_manager.set_alarm(user.id, hour, minute)
         
         await message.answer(
             f"✅ *Alarm set!*\n\n"
@@ -139,7 +149,7 @@ async def cmd_set(message: Message):
 async def cmd_status(message: Message):
     """Handle /status command."""
     chat_id = str(message.chat.id)
-    user = _get_user(chat_id)
+    user = await _get_user(chat_id)
     
     if not user:
         await message.answer("Please send /start to register first!")
@@ -174,7 +184,7 @@ async def cmd_status(message: Message):
 async def cmd_cancel(message: Message):
     """Handle /cancel command."""
     chat_id = str(message.chat.id)
-    user = _get_user(chat_id)
+    user = await _get_user(chat_id)
     
     if not user:
         await message.answer("Please send /start to register first!")
@@ -191,7 +201,7 @@ async def cmd_cancel(message: Message):
 async def cmd_stats(message: Message):
     """Handle /stats command."""
     chat_id = str(message.chat.id)
-    user = _get_user(chat_id)
+    user = await _get_user(chat_id)
     
     if not user:
         await message.answer("Please send /start to register first!")
@@ -222,7 +232,7 @@ async def cmd_stats(message: Message):
 async def cmd_test(message: Message):
     """Handle /test command - trigger alarm for testing."""
     chat_id = str(message.chat.id)
-    user = _get_user(chat_id)
+    user = await _get_user(chat_id)
     
     if not user:
         await message.answer("Please send /start to register first!")
@@ -230,7 +240,7 @@ async def cmd_test(message: Message):
     
     if _alarm_manager:
         now = datetime.now()
-        alarm = _alarm_manager.set_alarm(user.id, now.hour, now.minute)
+        alarm = await _alarm_manager.set_alarm(user.id, now.hour, now.minute)
         
         await message.answer(
             "🧪 *Test mode activated!*\n\n"
@@ -252,7 +262,7 @@ async def handle_text(message: Message):
             await message.answer("Please enter a valid name (1-50 characters).")
             return
         
-        user = db.register_user(chat_id, name)
+        user = await asyncio.to_thread(db.register_user, chat_id, name)
         _user_states.pop(chat_id, None)
         
         await message.answer(
@@ -267,13 +277,22 @@ async def handle_text(message: Message):
             parse_mode=ParseMode.MARKDOWN
         )
     else:
-        user = _get_user(chat_id)
+        user = await _get_user(chat_id)
         if not user:
             await message.answer("👋 Please send /start to register first!")
         else:
             await message.answer("Use /help to see available commands.")
 
 
+class _KeepAliveSession(AiohttpSession):
+    """aiogram's aiohttp session with a longer keep-alive on pooled connections."""
+    
+    def __init__(self):
+        super().__init__(limit=BOT_CONNECTION_LIMIT)
+        # aiogram builds its TCPConnector from these kwargs on first request
+        self._connector_init["keepalive_timeout"] = BOT_KEEPALIVE_SECONDS
+
+
 class TelegramBot:
     """Telegram bot wrapper using aiogram."""
     
@@ -297,7 +316,7 @@ class TelegramBot:
         print(f"[BOT] Initializing with token: {config.TELEGRAM_BOT_TOKEN[:10]}...{config.TELEGRAM_BOT_TOKEN[-5:]}")
         
         try:
-            self.bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+            self.bot = Bot(token=config.TELEGRAM_BOT_TOKEN, session=_KeepAliveSession())
             _bot = self.bot
             
             # Test connection